@@ -1,33 +1,49 @@
 # -*- coding: utf-8 -*-
+import calendar
+import concurrent.futures
 import contextlib
+import errno
 import functools
 import tempfile
 
 import click
 import collections
 
-import boto3
-from boto3.s3.transfer import S3Transfer
-from furl import furl
 import gc
-import requests
+import io
 import os
 import shutil
 import time
 import datetime
 import uuid
-import exifread
 import json
 import hashlib
+import re
 import subprocess
+import threading
 
 import sys
-from bs4 import BeautifulSoup
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
 from contexttimer import Timer
 
+# boto3, bs4, exifread, furl and requests are imported inside the functions
+# that need them. the loop commands are restarted after every iteration with
+# --hard-exit, so every subcommand should only pay for what it uses.
+
+
+# the camera workers set a prefix (the camera name) for their thread, so
+# the output of cameras running in parallel can be told apart.
+_log_context = threading.local()
+
 
 def log(txt):
     # txt = "{} {}".format(datetime.datetime.now(), txt)
+    prefix = getattr(_log_context, 'prefix', None)
+    if prefix:
+        txt = '[{}] {}'.format(prefix, txt)
     click.echo(txt)
 
 
@@ -48,7 +64,140 @@ def temporary_directory():
         shutil.rmtree(d)
 
 
+# linux/fs.h: _IOW(0x94, 9, int). clones the extents of one file into another
+# on filesystems that support it (btrfs, xfs, ...).
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _fsync_directory(path):
+    # makes the rename of a file inside path durable. not every platform and
+    # filesystem allows opening a directory, so this is best effort.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _reflink(src_fd, dst_fd):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _copy_file_contents(src_fd, dst_fd, size):
+    # copies size bytes from src_fd to dst_fd, preferring methods that do not
+    # pass the data through userspace. returns the name of the method used.
+    if _reflink(src_fd, dst_fd):
+        return 'reflink'
+    offset = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            if method == 'sendfile':
+                # sendfile writes at the current position of dst_fd
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+            while offset < size:
+                if method == 'copy_file_range':
+                    copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            # e.g. EXDEV on older kernels or ENOSYS/EINVAL on filesystems
+            # that do not support it. continue with the next method from
+            # wherever this one stopped.
+            continue
+        if offset >= size:
+            return method
+        # stopped early without an error. let the next method try to copy
+        # the rest.
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    for chunk in iter(lambda: os.read(src_fd, COPY_BUFFER_SIZE), b""):
+        view = memoryview(chunk)
+        while view:
+            written = os.write(dst_fd, view)
+            offset += written
+            view = view[written:]
+    if offset < size:
+        raise IOError(errno.EIO, 'copied {} of {} bytes'.format(offset, size))
+    return 'read/write'
+
+
+def transfer_file(source_path, destination_path, move=False):
+    """
+    copies (or moves, with move=True) source_path to destination_path.
+
+    on the same filesystem a move is a plain rename and a copy becomes a
+    hardlink. otherwise the data is copied into a temporary file next to the
+    destination (reflink, copy_file_range, sendfile or read/write, whichever
+    works first), fsynced and renamed into place, so the destination never
+    exists half-written. on a move the source is only removed after that.
+    returns the name of the method that was used.
+    """
+    destination_dir = os.path.dirname(os.path.abspath(destination_path))
+    tmp_path = os.path.join(
+        destination_dir,
+        '.partial-transfer.{}.{}'.format(uuid.uuid4(), os.path.basename(destination_path)),
+    )
+    if os.stat(source_path).st_dev == os.stat(destination_dir).st_dev:
+        try:
+            if move:
+                os.rename(source_path, destination_path)
+                return 'rename'
+            # link to a temporary name first, so an existing destination is
+            # replaced atomically (os.link refuses to overwrite).
+            os.link(source_path, tmp_path)
+            os.rename(tmp_path, destination_path)
+            return 'hardlink'
+        except OSError as e:
+            # EXDEV: same device but different mount (bind mounts).
+            # EPERM/ENOTSUP...: filesystem without hardlinks (e.g. vfat).
+            if e.errno == errno.ENOENT:
+                raise
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+    with open(source_path, 'rb') as src:
+        size = os.fstat(src.fileno()).st_size
+        try:
+            with open(tmp_path, 'wb') as dst:
+                method = _copy_file_contents(src.fileno(), dst.fileno(), size)
+                os.fsync(dst.fileno())
+                copied = os.fstat(dst.fileno()).st_size
+            if copied < size:
+                # never rename a short copy into place (or remove the source)
+                raise IOError(errno.EIO, '{}: copied {} of {} bytes'.format(source_path, copied, size))
+            if move:
+                shutil.copystat(source_path, tmp_path)
+            else:
+                shutil.copymode(source_path, tmp_path)
+            os.rename(tmp_path, destination_path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    _fsync_directory(destination_dir)
+    if move:
+        os.remove(source_path)
+    return method
+
+
 def extract_exif_date(image_path):
+    import exifread
     with open(image_path, 'rb') as img_file:
         tags = exifread.process_file(img_file)
     datetime_str = str(tags['EXIF DateTimeOriginal'])
@@ -82,11 +231,136 @@ def find_image_links(tag):
     )
 
 
-def list_images():
-    base_url = 'http://10.5.5.9/videos/DCIM/'
+_http_sessions = threading.local()
+
+
+def get_http_session():
+    # created on first use and reused, so the camera sees one keep-alive
+    # connection instead of a new one for every request. one per thread,
+    # because every camera worker runs in its own thread.
+    if getattr(_http_sessions, 'session', None) is None:
+        import requests
+        _http_sessions.session = requests.Session()
+    return _http_sessions.session
+
+
+# Cameras are configured with a json file (--cameras-config):
+#
+#   {"cameras": [
+#       {"name": "north", "base_url": "http://10.5.5.9"},
+#       {"name": "south", "base_url": "http://10.5.6.9", "output_prefix": "S"}
+#   ]}
+#
+# progress_namespace (subdirectory of the progress dir) and output_prefix
+# (prepended to the downloaded filename, e.g. S_G0070289.JPG) default to the
+# name, so cameras with the same filenames do not collide. The pacing options
+# in CAMERA_OPTIONS can be set per camera and override the command line.
+# Without a config there is a single camera with the old hard-coded address
+# and layout.
+DEFAULT_CAMERA = {
+    'name': 'gopro',
+    'base_url': 'http://10.5.5.9',
+    'progress_namespace': '',
+    'output_prefix': '',
+}
+CAMERA_OPTIONS = (
+    'image_download_sleep_duration',
+    'deletion_batch_size',
+    'deletion_sleep_duration',
+    'max_sleep_duration',
+    'poll_delay',
+    'limit',
+)
+
+
+def load_cameras(cameras_config=None):
+    if not cameras_config:
+        return [dict(DEFAULT_CAMERA)]
+    with open(cameras_config) as f:
+        config = json.load(f)
+    cameras = []
+    for camera_config in config.get('cameras', []):
+        if not camera_config.get('name'):
+            raise click.BadParameter('every camera needs a name', param_hint='--cameras-config')
+        camera = dict(
+            DEFAULT_CAMERA,
+            progress_namespace=camera_config['name'],
+            output_prefix=camera_config['name'],
+        )
+        camera.update(camera_config)
+        camera['base_url'] = camera['base_url'].rstrip('/')
+        cameras.append(camera)
+    if not cameras:
+        raise click.BadParameter('no cameras configured', param_hint='--cameras-config')
+    for key in ('name', 'progress_namespace', 'output_prefix'):
+        values = [camera[key] for camera in cameras]
+        if len(set(values)) != len(values):
+            raise click.BadParameter('{} must be unique per camera'.format(key), param_hint='--cameras-config')
+    return cameras
+
+
+def camera_progress_dir(progress_dir, camera):
+    return os.path.join(progress_dir, camera['progress_namespace'])
+
+
+def camera_image_filename(camera, image_filename):
+    # the filename the image is downloaded to
+    if not camera['output_prefix']:
+        return image_filename
+    return '{}_{}'.format(camera['output_prefix'], image_filename)
+
+
+def camera_kwargs(camera, **kwargs):
+    kwargs.update((key, camera[key]) for key in CAMERA_OPTIONS if key in camera)
+    kwargs['camera'] = camera
+    return kwargs
+
+
+def run_camera_workers(func, cameras, fail_fast=False, **kwargs):
+    # runs func(camera=camera, **kwargs) for every camera, each in its own
+    # thread, and waits for all of them. returns the names of the cameras
+    # whose worker raised. with fail_fast it returns as soon as one worker
+    # raised, leaving the others running (they are daemon threads, so they
+    # end with the process). used for workers that never return.
+    if len(cameras) == 1:
+        func(**camera_kwargs(cameras[0], **kwargs))
+        return []
+    failed = []
+
+    def worker(camera):
+        _log_context.prefix = camera['name']
+        try:
+            func(**camera_kwargs(camera, **kwargs))
+        except Exception as e:
+            log('[!!!!!] {}'.format(e))
+            failed.append(camera['name'])
+
+    threads = [
+        threading.Thread(
+            target=worker,
+            name='camera-{}'.format(camera['name']),
+            args=(camera,),
+        )
+        for camera in cameras
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout, so ctrl-c still reaches the main thread
+        while thread.is_alive():
+            if fail_fast and failed:
+                return list(failed)
+            thread.join(1)
+    return failed
+
+
+def list_images(base_url=DEFAULT_CAMERA['base_url']):
+    from bs4 import BeautifulSoup
+    base_url = '{}/videos/DCIM/'.format(base_url)
     log("--> listing base directories from: {}".format(base_url))
     index = BeautifulSoup(
-        requests.get(base_url).content,
+        get_http_session().get(base_url).content,
         'html.parser',
     )
     directories = reversed(index.find_all(find_directory_links))
@@ -94,7 +368,7 @@ def list_images():
         directory_url = "".join([base_url, directory.attrs['href']])
         log("--> listing images from: {}".format(directory_url))
         images = BeautifulSoup(
-            requests.get(directory_url).content,
+            get_http_session().get(directory_url).content,
             'html.parser',
         ).find_all(find_image_links)
         for image in reversed(images):
@@ -102,9 +376,39 @@ def list_images():
             yield image_url
 
 
+def progress_filepath(progress_dir, image_filename):
+    return os.path.join(
+        progress_dir,
+        image_filename[0:3],
+        image_filename[3:6],
+        '{}.json'.format(image_filename),
+    )
+
+
+def read_json(path):
+    # progress files written by older versions are empty
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_json(path, data):
+    mkdirs(os.path.dirname(path))
+    tmp_path = os.path.join(
+        os.path.dirname(path),
+        '.partial-json.{}.{}'.format(uuid.uuid4(), os.path.basename(path)),
+    )
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
 def download_all_images(
         target_dir,
         progress_dir,
+        camera=DEFAULT_CAMERA,
         skip_existing=True,
         delete_after_download=False,
         check=None,
@@ -112,25 +416,26 @@ def download_all_images(
         limit=None,
         **kwargs
 ):
-    log("==> DOWNLOADING images to {}".format(target_dir))
+    log("==> DOWNLOADING images from {} to {}".format(camera['name'], target_dir))
     target_dir = os.path.abspath(target_dir)
-    progress_dir = os.path.abspath(progress_dir)
+    progress_dir = os.path.abspath(camera_progress_dir(progress_dir, camera))
     if check_and_raise(check):
         mkdirs(target_dir)
         mkdirs(progress_dir)
     is_first = True
     count = 1
-    for image_url in list_images():
+    downloaded = []
+    for image_url in list_images(camera['base_url']):
         image_filename = image_url.split('/')[-1]
-        progress_filename = '{}.json'.format(image_filename)
-        progress_filepath = os.path.join(progress_dir, image_filename[0:3], image_filename[3:6], progress_filename)
-        if skip_existing and os.path.exists(progress_filepath):
+        target_filename = camera_image_filename(camera, image_filename)
+        image_progress_filepath = progress_filepath(progress_dir, image_filename)
+        if skip_existing and os.path.exists(image_progress_filepath):
             log('   skipping download of {}'.format(image_url))
             if delete_after_download:
                 if is_first:
                     log('not deleting previously downloaded {} because it is the newest image'.format(image_url))
                 else:
-                    delete_image(image_url)
+                    enqueue_deletion(progress_dir, image_url)
             is_first = False
             continue
         log('--> downloading [{} of {}] {}'.format(
@@ -138,31 +443,41 @@ def download_all_images(
             limit or 'inf',
             image_url,
         ))
-        real_delete_after_download = delete_after_download and not is_first
-        raw_image_path = download(
+        progress = download(
             image_url,
             target_dir=target_dir,
-            delete_after_download=real_delete_after_download,
+            target_filename=target_filename,
             check=check,
         )
         count += 1
-        if raw_image_path and os.path.exists(raw_image_path):
-            mkdirs(os.path.dirname(progress_filepath))
-            with open(progress_filepath, 'w+') as f:
-                json.dumps({}, f)
-        if delete_after_download and not real_delete_after_download:
-            log('did not delete {} because it is the newest image'.format(image_url))
+        if progress:
+            try:
+                progress['shot_at'] = calendar.timegm(
+                    extract_exif_date(os.path.join(target_dir, target_filename)).timetuple()
+                )
+            except Exception as e:
+                log('   could not read capture time of {}: {}'.format(target_filename, e))
+            write_json(image_progress_filepath, progress)
+            downloaded.append(progress)
+            if delete_after_download:
+                if is_first:
+                    log('did not delete {} because it is the newest image'.format(image_url))
+                else:
+                    enqueue_deletion(progress_dir, image_url)
         is_first = False
         # if we've reached the download limit, stop.
         if limit and count > limit:
-            return
+            return downloaded
         # desparate attempt to not have the gopro crash
         log('    sleeping for {}s, so gopro does not crash'.format(image_download_sleep_duration))
         time.sleep(image_download_sleep_duration)
+    return downloaded
 
 
-def download(url, target_dir, delete_after_download=False, check=None):
-    image_filename = url.split('/')[-1]
+def download(url, target_dir, target_filename=None, check=None):
+    # returns the progress entry for the downloaded image (size and md5 of
+    # what was written to disk) or None if the download failed.
+    image_filename = target_filename or url.split('/')[-1]
     target_path_tmp = os.path.join(
         target_dir,
         '.partial-download.{}.{}'.format(uuid.uuid4(), image_filename),
@@ -174,33 +489,172 @@ def download(url, target_dir, delete_after_download=False, check=None):
     check_and_raise(check)
     if not os.path.exists(os.path.dirname(target_dir)):
         os.makedirs(os.path.dirname(target_dir))
-    r = requests.get(url, stream=True)
+    hash_md5 = hashlib.md5()
+    size = 0
     try:
+        r = get_http_session().get(url, stream=True)
+        r.raise_for_status()
         with open(target_path_tmp, 'wb') as f:
             for chunk in r.iter_content(chunk_size=1024):
                 if chunk:
                     f.write(chunk)
+                    hash_md5.update(chunk)
+                    size += len(chunk)
+        content_length = r.headers.get('Content-Length')
+        if content_length is not None and int(content_length) != size:
+            raise Exception('got {} bytes, expected {}'.format(size, content_length))
     except Exception as e:
         log("ERROR DOWNLOADING IMAGE: {}".format(e))
         try:
             os.remove(target_path_tmp)
         except:
             pass
-    else:
-        if not os.path.exists(os.path.dirname(target_path_dl)):
-            os.makedirs(os.path.dirname(target_path_dl))
-        shutil.move(target_path_tmp, target_path_dl)
-        if delete_after_download:
-            delete_image(url)
-    return target_path_dl
-
-
-def delete_image(url):
+        return None
+    if not os.path.exists(os.path.dirname(target_path_dl)):
+        os.makedirs(os.path.dirname(target_path_dl))
+    transfer_file(target_path_tmp, target_path_dl, move=True)
+    return {
+        'url': url,
+        'filename': image_filename,
+        'size': size,
+        'content_length': int(content_length) if content_length is not None else None,
+        'md5': hash_md5.hexdigest(),
+        'downloaded_at': time.time(),
+    }
+
+
+def delete_image(url, base_url=DEFAULT_CAMERA['base_url']):
+    # returns whether the camera confirmed the deletion
     rel_path = url.split('/DCIM')[-1]
     log('deleting {}'.format(rel_path))
-    requests.get(
-        "http://10.5.5.9/gp/gpControl/command/storage/delete?p={}".format(rel_path),
+    r = get_http_session().get(
+        "{}/gp/gpControl/command/storage/delete?p={}".format(base_url, rel_path),
     )
+    return r.status_code == 200
+
+
+# Deleting images from the camera is deferred to a queue, so the camera does
+# not get a delete request for every download during the busy window. Queue
+# entries live in a flat directory inside the progress dir and are drained at
+# a controlled rate between download passes by drain_deletion_queue. A
+# failed deletion is retried with exponential backoff and given up after
+# DELETION_MAX_ATTEMPTS; the progress entry then records deletion_failed_at
+# and the image is not queued again.
+DELETION_QUEUE_DIRNAME = '.deletion-queue'
+DELETION_MAX_ATTEMPTS = 5
+DELETION_RETRY_DELAY = 60
+
+
+def deletion_queue_filepath(progress_dir, image_filename):
+    return os.path.join(progress_dir, DELETION_QUEUE_DIRNAME, '{}.json'.format(image_filename))
+
+
+def enqueue_deletion(progress_dir, url):
+    image_filename = url.split('/')[-1]
+    queue_filepath = deletion_queue_filepath(progress_dir, image_filename)
+    if os.path.exists(queue_filepath):
+        return
+    progress = read_json(progress_filepath(progress_dir, image_filename))
+    if progress.get('deleted_at') or progress.get('deletion_failed_at') or not is_verified_download(progress):
+        return
+    log('   queueing deletion of {}'.format(image_filename))
+    write_json(queue_filepath, {'url': url, 'queued_at': time.time(), 'attempts': 0})
+
+
+def is_verified_download(progress, raw_image_path=None):
+    # only images whose download was verified against the size the camera
+    # announced, and that have a checksum, may be deleted from the camera.
+    # without a Content-Length a truncated download cannot be told apart
+    # from a complete one, so it is never verified.
+    if not progress.get('md5') or progress.get('size') is None:
+        return False
+    if progress.get('content_length') is None or progress['content_length'] != progress['size']:
+        return False
+    if raw_image_path and os.path.exists(raw_image_path):
+        # not processed yet. make sure the file on disk is still intact.
+        try:
+            if os.path.getsize(raw_image_path) != progress['size']:
+                return False
+            if md5(raw_image_path) != progress['md5']:
+                return False
+        except OSError:
+            # moved away by process in the meantime. the download itself
+            # was verified above.
+            pass
+    return True
+
+
+def drain_deletion_queue(
+        progress_dir,
+        target_dir=None,
+        camera=DEFAULT_CAMERA,
+        deletion_batch_size=10,
+        deletion_sleep_duration=1.0,
+        **kwargs
+):
+    # deletes up to deletion_batch_size queued images from the camera, oldest
+    # first, sleeping deletion_sleep_duration between requests.
+    progress_dir = os.path.abspath(camera_progress_dir(progress_dir, camera))
+    queue_dir = os.path.join(progress_dir, DELETION_QUEUE_DIRNAME)
+    if not os.path.isdir(queue_dir):
+        return
+    queue = [
+        (filename, read_json(os.path.join(queue_dir, filename)))
+        for filename in os.listdir(queue_dir)
+        if filename.endswith('.json') and not filename.startswith('.')
+    ]
+    if not queue:
+        return
+    # oldest first
+    queue.sort(key=lambda item: (item[1].get('queued_at', 0), item[0]))
+    log('==> DELETING queued images from {} ({} queued, batch of {})'.format(
+        camera['name'],
+        len(queue),
+        deletion_batch_size,
+    ))
+    count = 0
+    for queue_filename, entry in queue:
+        if deletion_batch_size and count >= deletion_batch_size:
+            return
+        if entry.get('retry_at', 0) > time.time():
+            continue
+        queue_filepath = os.path.join(queue_dir, queue_filename)
+        image_filename = queue_filename[:-len('.json')]
+        image_progress_filepath = progress_filepath(progress_dir, image_filename)
+        progress = read_json(image_progress_filepath)
+        if progress.get('deleted_at'):
+            log('   {} already deleted from camera'.format(image_filename))
+            os.remove(queue_filepath)
+            continue
+        raw_image_path = None
+        if target_dir:
+            raw_image_path = os.path.join(target_dir, camera_image_filename(camera, image_filename))
+        if not entry.get('url') or not is_verified_download(progress, raw_image_path):
+            log('   not deleting {}: download not verified'.format(image_filename))
+            os.remove(queue_filepath)
+            continue
+        if count:
+            time.sleep(deletion_sleep_duration)
+        count += 1
+        try:
+            deleted = delete_image(entry['url'], camera['base_url'])
+        except Exception as e:
+            log('   deleting {} failed: {}'.format(image_filename, e))
+            deleted = False
+        if deleted:
+            progress['deleted_at'] = time.time()
+            write_json(image_progress_filepath, progress)
+            os.remove(queue_filepath)
+        else:
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            if entry['attempts'] >= DELETION_MAX_ATTEMPTS:
+                log('   giving up deleting {} after {} attempts'.format(image_filename, entry['attempts']))
+                progress['deletion_failed_at'] = time.time()
+                write_json(image_progress_filepath, progress)
+                os.remove(queue_filepath)
+            else:
+                entry['retry_at'] = time.time() + DELETION_RETRY_DELAY * 2 ** (entry['attempts'] - 1)
+                write_json(queue_filepath, entry)
 
 
 def check_stick_connected(path, filename=None):
@@ -220,7 +674,7 @@ def check_and_raise(check_func):
     return True
 
 
-def resize_image(source_file, target_file, resolution, optimise, dryrun=False):
+def resize_image(source_file, target_file, resolution, optimise, max_bytes=None, dryrun=False):
     cmd = 'convert {source_file} -resize {resolution} {target_file}'.format(
         source_file=source_file,
         resolution=resolution,
@@ -237,7 +691,12 @@ def resize_image(source_file, target_file, resolution, optimise, dryrun=False):
         click.echo(' -[{}]-> resized to {} {}'.format(t_resize.elapsed, resolution, os.path.basename(source_file)))
     if optimise:
         with Timer() as t_opt:
-            cmd = 'jpegoptim --strip-all {}'.format(target_file)
+            if max_bytes:
+                # jpegoptim takes the target size in kB and searches the
+                # quality for it
+                cmd = 'jpegoptim --strip-all --size={}k {}'.format(max(1, max_bytes // 1024), target_file)
+            else:
+                cmd = 'jpegoptim --strip-all {}'.format(target_file)
             if dryrun:
                 click.echo(' dryrun --> [{}] {}'.format(resolution, cmd))
             else:
@@ -248,6 +707,210 @@ def resize_image(source_file, target_file, resolution, optimise, dryrun=False):
         click.echo(' -[{}]-> optimised {} {}'.format(t_opt.elapsed, resolution, os.path.basename(source_file)))
 
 
+# Besides the jpegoptim'ed JPEG, every resized tier can be written in extra
+# formats (--extra-format RESOLUTION:FORMAT[:MAX_BYTES]). They go to their
+# own tier directory (e.g. 640x480-webp/) with the usual filename scheme and
+# the extension of the format. With MAX_BYTES, the highest quality that fits
+# is searched for. The JPEG tiers get a byte budget with
+# --tier-budget RESOLUTION:MAX_BYTES, which jpegoptim --size enforces.
+OUTPUT_FORMATS = {
+    'webp': {
+        'extension': 'webp',
+        'content_type': 'image/webp',
+        'options': '-strip -define webp:method=6',
+    },
+    'pjpeg': {
+        'extension': 'JPG',
+        'content_type': 'image/jpeg',
+        'options': '-strip -interlace Plane -sampling-factor 4:2:0',
+    },
+}
+CONTENT_TYPES = dict(
+    [('.jpg', 'image/jpeg'), ('.jpeg', 'image/jpeg')] +
+    [('.' + f['extension'].lower(), f['content_type']) for f in OUTPUT_FORMATS.values()]
+)
+DEFAULT_QUALITY = 80
+MIN_QUALITY = 30
+MAX_QUALITY = 90
+
+
+def content_type(filename):
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
+
+
+def extra_format_tier(extra_format):
+    return '{}-{}'.format(extra_format['resolution'], extra_format['format'])
+
+
+def parse_extra_formats(ctx, param, values):
+    extra_formats = []
+    for value in values:
+        parts = value.split(':')
+        if len(parts) not in (2, 3) or parts[0] not in RESOLUTIONS or parts[1] not in OUTPUT_FORMATS:
+            raise click.BadParameter(
+                '"{}" should be RESOLUTION:FORMAT[:MAX_BYTES] with RESOLUTION one of {} and FORMAT one of {}'.format(
+                    value, ', '.join(RESOLUTIONS), ', '.join(sorted(OUTPUT_FORMATS)),
+                )
+            )
+        try:
+            max_bytes = int(parts[2]) if len(parts) == 3 else None
+        except ValueError:
+            raise click.BadParameter('"{}": MAX_BYTES must be a number'.format(value))
+        extra_formats.append({'resolution': parts[0], 'format': parts[1], 'max_bytes': max_bytes})
+    return extra_formats
+
+
+def parse_tier_budgets(ctx, param, values):
+    tier_budgets = {}
+    for value in values:
+        parts = value.split(':')
+        if len(parts) != 2 or parts[0] not in RESOLUTIONS or not parts[1].isdigit():
+            raise click.BadParameter(
+                '"{}" should be RESOLUTION:MAX_BYTES with RESOLUTION one of {}'.format(value, ', '.join(RESOLUTIONS))
+            )
+        tier_budgets[parts[0]] = int(parts[1])
+    return tier_budgets
+
+
+def scale_image_lossless(source_file, target_file, resolution, dryrun=False):
+    # resizes to an uncompressed intermediate (target_file should end in
+    # .ppm) that encode_image can encode as often as it needs to.
+    # jpeg:size lets the jpeg decoder skip most of the full resolution image.
+    cmd = 'convert -define jpeg:size={resolution} {source_file} -resize {resolution} {target_file}'.format(
+        source_file=source_file,
+        resolution=resolution,
+        target_file=target_file,
+    )
+    if dryrun:
+        click.echo(' dryrun --> [{}] {}'.format(resolution, cmd))
+        return
+    with Timer() as t_scale:
+        p = subprocess.Popen(cmd, shell=True)
+        p.wait()
+        if p.returncode:
+            raise Exception('[!!!!!] "{}" failed! '.format(cmd))
+    click.echo(' -[{}]-> scaled to {} {}'.format(t_scale.elapsed, resolution, os.path.basename(target_file)))
+
+
+def encode_image(source_file, target_file, resolution, output_format, max_bytes=None, dryrun=False):
+    # source_file is already scaled to resolution (see scale_image_lossless)
+    options = OUTPUT_FORMATS[output_format]['options']
+
+    def encode(quality):
+        cmd = 'convert {source_file} {options} -quality {quality} {target_file}'.format(
+            source_file=source_file,
+            options=options,
+            quality=quality,
+            target_file=target_file,
+        )
+        if dryrun:
+            click.echo(' dryrun --> [{}] {}'.format(resolution, cmd))
+            return 0
+        p = subprocess.Popen(cmd, shell=True)
+        p.wait()
+        if p.returncode:
+            raise Exception('[!!!!!] "{}" failed! '.format(cmd))
+        return os.path.getsize(target_file)
+
+    with Timer() as t_encode:
+        if not max_bytes or dryrun:
+            quality = DEFAULT_QUALITY
+            size = encode(quality)
+        else:
+            # binary search for the highest quality within the budget
+            low, high = MIN_QUALITY, MAX_QUALITY
+            quality, encoded, size = None, None, None
+            while low <= high:
+                encoded = (low + high) // 2
+                size = encode(encoded)
+                if size <= max_bytes:
+                    quality = encoded
+                    low = encoded + 1
+                else:
+                    high = encoded - 1
+            if quality is None:
+                click.echo(' !-> {} {} does not fit in {} bytes even at quality {}'.format(
+                    output_format, resolution, max_bytes, MIN_QUALITY,
+                ))
+                quality = MIN_QUALITY
+            if encoded != quality:
+                # the last attempt was too big, go back to the best fit
+                size = encode(quality)
+    click.echo(' -[{}]-> encoded {} {} at quality {} ({} bytes) {}'.format(
+        t_encode.elapsed, output_format, resolution, quality, size, os.path.basename(target_file),
+    ))
+
+
+# Near-duplicate detection (process --dedup). At night or without activity
+# consecutive frames are almost identical. Before anything is resized, a
+# 64 bit difference hash of a tiny thumbnail of the original is compared to
+# the hash of the last frame that was kept from the same camera (frames are
+# processed in filename order, which is capture order per camera). Frames
+# within --dedup-threshold bits are duplicates: the tiers selected with
+# --dedup-skip-tier are not resized or written, and the frame is recorded
+# in the duplicates manifest. If the original is skipped, it is archived in
+# DUPLICATES_DIRNAME, which upload does not look at unless
+# --include-duplicates is given. A reprocess without --dedup brings the
+# skipped tiers back.
+DEDUP_STATE_FILENAME = '.dedup-state.json'
+DUPLICATES_MANIFEST_FILENAME = '.duplicates.jsonl'
+DUPLICATES_DIRNAME = '.duplicates'
+
+
+def perceptual_hash(image_file):
+    # dHash: shrink to 9x8 grayscale and compare every pixel to its right
+    # neighbour. returns 64 bits as hex. jpeg:size lets the jpeg decoder
+    # skip most of the full resolution image.
+    pixels = bytearray(subprocess.check_output([
+        'convert', '-define', 'jpeg:size=144x128', image_file,
+        '-colorspace', 'Gray', '-resize', '9x8!', '-depth', '8', 'gray:-',
+    ]))
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | int(pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return '{:016x}'.format(bits)
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def dedup_key(source_filename):
+    # frames are only compared with frames of the same camera, i.e. with the
+    # same output prefix (north_G0070289.JPG -> north, G0070289.JPG -> '')
+    name = os.path.splitext(source_filename)[0]
+    return name.rsplit('_', 1)[0] if '_' in name else ''
+
+
+def detect_duplicate(target_dir, image_file, source_filename, threshold):
+    # returns details about the kept frame image_file is a near-duplicate
+    # of, or None if it is not a duplicate. in that case it becomes the new
+    # kept frame of its camera.
+    state_file = os.path.join(target_dir, DEDUP_STATE_FILENAME)
+    state = read_json(state_file)
+    key = dedup_key(source_filename)
+    kept = state.get(key)
+    image_hash = perceptual_hash(image_file)
+    if isinstance(kept, dict) and kept.get('hash'):
+        distance = hamming_distance(image_hash, kept['hash'])
+        if distance <= threshold:
+            return {
+                'hash': image_hash,
+                'distance': distance,
+                'duplicate_of': kept['source_filename'],
+            }
+    state[key] = {'hash': image_hash, 'source_filename': source_filename}
+    write_json(state_file, state)
+    return None
+
+
+def record_duplicate(target_dir, entry):
+    mkdirs(target_dir)
+    with open(os.path.join(target_dir, DUPLICATES_MANIFEST_FILENAME), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
 def resize_images(
         source_file,
         source_filename,
@@ -255,9 +918,15 @@ def resize_images(
         resolutions,
         shot_at,
         optimise=True,
+        extra_formats=None,
+        tier_budgets=None,
+        skip_tiers=None,
         check=None,
         dryrun=False
 ):
+    # extra format tiers in skip_tiers are not encoded. extra formats of a
+    # resolution that is not in resolutions are skipped as well.
+    skip_tiers = skip_tiers or []
     # this is optimised to use the already created smaller version of the image
     # as a basis for the next smaller size.
     with temporary_directory() as tmpdir:
@@ -283,15 +952,57 @@ def resize_images(
                 target_file=img['tmp_target_file'],
                 resolution=img['resolution'],
                 optimise=optimise,
+                max_bytes=(tier_budgets or {}).get(img['resolution']),
                 dryrun=dryrun,
             )
-        for img in imgs.values():
+        outputs = [
+            dict(img, tier=img['resolution'], source_filename=source_filename)
+            for img in imgs.values()
+        ]
+        # extra formats are encoded from the original, not from one of the
+        # optimised JPEG tiers, so they are only compressed once. the
+        # original is scaled once per resolution to a lossless intermediate,
+        # which the quality search then encodes repeatedly.
+        scaled_files = {}
+        for extra_format in extra_formats or []:
+            img = imgs.get(extra_format['resolution'])
+            if img is None or extra_format_tier(extra_format) in skip_tiers:
+                continue
+            extra_source_filename = '{}.{}'.format(
+                os.path.splitext(source_filename)[0],
+                OUTPUT_FORMATS[extra_format['format']]['extension'],
+            )
+            tmp_target_file = os.path.join(tmpdir, '{}-{}'.format(extra_format_tier(extra_format), extra_source_filename))
+            check_and_raise(check)
+            if img['resolution'] not in scaled_files:
+                scaled_files[img['resolution']] = os.path.join(tmpdir, '{}-scaled.ppm'.format(img['resolution']))
+                scale_image_lossless(
+                    source_file=source_file,
+                    target_file=scaled_files[img['resolution']],
+                    resolution=img['resolution'],
+                    dryrun=dryrun,
+                )
+            encode_image(
+                source_file=scaled_files[img['resolution']],
+                target_file=tmp_target_file,
+                resolution=img['resolution'],
+                output_format=extra_format['format'],
+                max_bytes=extra_format['max_bytes'],
+                dryrun=dryrun,
+            )
+            outputs.append({
+                'tmp_target_file': tmp_target_file,
+                'resolution': img['resolution'],
+                'tier': extra_format_tier(extra_format),
+                'source_filename': extra_source_filename,
+            })
+        for img in outputs:
             target_file = os.path.join(
                 target_dir,
-                img['resolution'],
+                img['tier'],
                 generate_relative_image_path(
                     source_file=img['tmp_target_file'],
-                    source_filename=source_filename,
+                    source_filename=img['source_filename'],
                     shot_at=shot_at,
                     resolution=img['resolution'],
                     dryrun=dryrun,
@@ -302,13 +1013,23 @@ def resize_images(
             else:
                 check_and_raise(check)
                 mkdirs(os.path.dirname(target_file))
-                shutil.move(img['tmp_target_file'], target_file)
+                transfer_file(img['tmp_target_file'], target_file, move=True)
 
 
 def datetime_to_datetimestr(dt):
     return dt.strftime('%Y-%m-%d'), dt.strftime('%Y-%m-%d_%H-%M-%S')
 
 
+def datetimestr_to_timestamp(filename):
+    # reads the capture time back from a filename created by
+    # generate_relative_image_path. returns None for other filenames.
+    try:
+        dt = datetime.datetime.strptime(filename[:19], '%Y-%m-%d_%H-%M-%S')
+    except ValueError:
+        return None
+    return calendar.timegm(dt.timetuple())
+
+
 def generate_relative_image_path(source_file, source_filename, shot_at, resolution, dryrun):
     source_filename, extension = os.path.splitext(source_filename)
     extension = extension[1:]
@@ -325,12 +1046,18 @@ def generate_relative_image_path(source_file, source_filename, shot_at, resoluti
     return new_path
 
 
+RESOLUTIONS = ['640x480', '320x240', '160x120']
+
+
 def process_image(
         source_file,
         target_dir,
         copy,
         resize,
         source_filename=None,
+        extra_formats=None,
+        tier_budgets=None,
+        dedup=None,
         dryrun=False,
         check=None,
         skip_existing=True,
@@ -340,8 +1067,7 @@ def process_image(
     shot_at = extract_exif_date(image_path=source_file)
     click.echo(' --> shot at {}'.format(shot_at))
     source_filename = source_filename or os.path.basename(source_file)
-    new_path = os.path.join(
-        target_dir,
+    relative_path = os.path.join(
         'original',
         generate_relative_image_path(
             source_file=source_file,
@@ -351,13 +1077,33 @@ def process_image(
             dryrun=dryrun,
         )
     )
-    if skip_existing and os.path.exists(new_path):
+    new_path = os.path.join(target_dir, relative_path)
+    archived_path = os.path.join(target_dir, DUPLICATES_DIRNAME, relative_path)
+    if skip_existing and (os.path.exists(new_path) or os.path.exists(archived_path)):
         click.echo(' !-> skipping {} because destination already exists'.format(
             source_filename
         ))
         return
+    duplicate = None
+    skip_tiers = []
+    if dedup and not dryrun:
+        duplicate = detect_duplicate(target_dir, source_file, source_filename, dedup['threshold'])
+    if duplicate:
+        skip_tiers = dedup['skip_tiers']
+        click.echo(' --> near-duplicate of {} (distance {}), skipping {}'.format(
+            duplicate['duplicate_of'], duplicate['distance'], ', '.join(skip_tiers),
+        ))
+        if 'original' in skip_tiers:
+            new_path = archived_path
+        record_duplicate(target_dir, dict(
+            duplicate,
+            source_filename=source_filename,
+            shot_at=shot_at.isoformat(),
+            skipped_tiers=skip_tiers,
+            archived_as=os.path.relpath(new_path, target_dir) if new_path == archived_path else None,
+        ))
     if resize:
-        resolutions = ['640x480', '320x240', '160x120']
+        resolutions = [resolution for resolution in RESOLUTIONS if resolution not in skip_tiers]
         click.echo(' --> resizing to {}'.format(' '.join(resolutions)))
         resize_images(
             source_file=source_file,
@@ -365,6 +1111,9 @@ def process_image(
             resolutions=resolutions,
             shot_at=shot_at,
             source_filename=source_filename,
+            extra_formats=extra_formats,
+            tier_budgets=tier_budgets,
+            skip_tiers=skip_tiers,
             check=check,
             dryrun=dryrun,
         )
@@ -379,14 +1128,15 @@ def process_image(
     else:
         check_and_raise(check)
         mkdirs(os.path.dirname(new_path))
-        if copy:
-            shutil.copy(source_file, new_path)
-        else:
-            shutil.move(source_file, new_path)
+        transfer_file(source_file, new_path, move=not copy)
 
 
 def process_all_images(source_dir, **kwargs):
-    for filename in reversed(os.listdir(source_dir)):
+    filenames = os.listdir(source_dir)
+    # dedup compares each frame with the previous one, so it needs capture
+    # order. the camera numbers its frames sequentially.
+    filenames = sorted(filenames) if kwargs.get('dedup') else reversed(filenames)
+    for filename in filenames:
         filepath = os.path.join(source_dir, filename)
         if not os.path.isfile(filepath):
             continue
@@ -406,104 +1156,347 @@ def _is_image(directory, filename):
     ])
 
 
-def _extract_original_filename(filename):
-    # old format: 2016-05-03_00-02-59_A_G0070289.JPG
-    # new format: 2016-05-03_00-02-59.A_G0070289.original.6c227c09a043c0e30a86a61ddd445734.JPG
-    # remove the date and time
-    filename = filename[20:]
-    # remove '.' seperated stuff in the middle (size and checksum with new format)
-    split = filename.split('.')
-    filename = '{}.{}'.format(split[0], split[-1])
+# new format: 2016-05-03_00-02-59.A_G0070289.original.6c227c09a043c0e30a86a61ddd445734.JPG
+# (see generate_relative_image_path)
+PROCESSED_FILENAME_RE = re.compile(
+    r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}\.(?P<name>.+)\.[^.]+\.(?:[0-9a-fA-F]{32}|DRYRUN-MD5)\.(?P<extension>[^.]+)$'
+)
+# old format: 2016-05-03_00-02-59_A_G0070289.JPG
+OLD_PROCESSED_FILENAME_RE = re.compile(
+    r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_(?P<name>.+)\.(?P<extension>[^.]+)$'
+)
+
+
+def extract_original_filename(filename):
+    # A_G0070289.JPG for both formats. other filenames are returned as is.
+    for regex in (PROCESSED_FILENAME_RE, OLD_PROCESSED_FILENAME_RE):
+        match = regex.match(filename)
+        if match:
+            return '{}.{}'.format(match.group('name'), match.group('extension'))
     return filename
 
 
-def _reprocess_daydir_with_progress(**kwargs):
-    day_dir = os.path.join(kwargs['source_dir'], kwargs['day_subdir'])
-    if os.path.isdir(day_dir):
-        source_filenames = [
-            filename for filename in os.listdir(day_dir)
-            if _is_image(day_dir, filename)
-        ]
-    else:
-        source_filenames = []
-    kwargs['source_filenames'] = source_filenames
-    with click.progressbar(length=len(source_filenames), label='PROGRESS {} '.format(kwargs['day_subdir'])) as bar:
-        kwargs['bar'] = bar
-        reprocess_daydir(**kwargs)
+# reprocess works in two steps. First it plans: it indexes the whole source
+# archive and the destination and writes every image that is missing (or
+# differs in size, or lacks a resized tier) as a task to a journal. Then it
+# executes the tasks in parallel and appends a line to the journal for every
+# finished one. An interrupted run picks up the journal and only does what is
+# left. The journal is removed once everything is done.
+#
+# journal format (json lines):
+#   {"type": "plan", "source_dir": ..., "target_dir": ..., "resize": ..., "copy": ..., "total": ...}
+#   {"type": "task", "id": 0, "day": "2016-05-03", "filename": ..., "source_filename": ...}
+#   ...
+#   {"type": "done", "id": 0}
+
+
+def _index_tier(target_dir, tier, day_subdir):
+    # {original filename without extension: size} of the images of one day
+    # in one tier. without extension, because extra formats have their own.
+    tier_dir = os.path.join(target_dir, tier, day_subdir)
+    if not os.path.isdir(tier_dir):
+        return {}
+    return dict(
+        (
+            os.path.splitext(extract_original_filename(filename))[0],
+            os.path.getsize(os.path.join(tier_dir, filename)),
+        )
+        for filename in os.listdir(tier_dir)
+        if not filename.startswith('.') and os.path.isfile(os.path.join(tier_dir, filename))
+    )
 
 
-def reprocess_daydir(day_subdir, source_dir, target_dir, resize, copy, dryrun=False, source_filenames=None, bar=None):
-    day_dir = os.path.join(source_dir, day_subdir)
-    if not os.path.isdir(day_dir):
-        return
-    source_filenames = source_filenames or [
-        filename for filename in os.listdir(day_dir)
-        if _is_image(day_dir, filename)
-    ]
-    originals_target_dir = os.path.join(target_dir, 'original', day_subdir)
-    if os.path.isdir(originals_target_dir):
-        destination_filenames = [
-            filename
-            for filename in os.listdir(originals_target_dir)
-            if _is_image(originals_target_dir, filename)
-        ]
-    else:
-        destination_filenames = []
-    if len(source_filenames) == len(destination_filenames):
-        click.echo(' --> {} and {} have the same amount of images. skipping.'.format(
-            source_dir, originals_target_dir,
-        ))
-        if bar:
-            bar.update(len(source_filenames))
+def plan_reprocess(source_dir, target_dir, resize, extra_formats=None):
+    tiers = ['original']
+    if resize:
+        tiers += RESOLUTIONS + [extra_format_tier(extra_format) for extra_format in extra_formats or []]
+    day_subdirs = sorted(
+        d for d in os.listdir(source_dir)
+        if not d.startswith('.') and os.path.isdir(os.path.join(source_dir, d))
+    )
+    tasks = []
+    for day_subdir in day_subdirs:
+        day_dir = os.path.join(source_dir, day_subdir)
+        destination = dict((tier, _index_tier(target_dir, tier, day_subdir)) for tier in tiers)
+        for filename in sorted(os.listdir(day_dir)):
+            if not _is_image(day_dir, filename):
+                continue
+            source_filename = extract_original_filename(filename)
+            name = os.path.splitext(source_filename)[0]
+            size = os.path.getsize(os.path.join(day_dir, filename))
+            if (
+                destination['original'].get(name) == size and
+                all(name in destination[tier] for tier in tiers[1:])
+            ):
+                continue
+            tasks.append({
+                'type': 'task',
+                'id': len(tasks),
+                'day': day_subdir,
+                'filename': filename,
+                'source_filename': source_filename,
+            })
+    return tasks
+
+
+def write_reprocess_journal(journal_file, plan, tasks):
+    mkdirs(os.path.dirname(journal_file))
+    tmp_path = os.path.join(
+        os.path.dirname(journal_file),
+        '.partial-journal.{}.{}'.format(uuid.uuid4(), os.path.basename(journal_file)),
+    )
+    with open(tmp_path, 'w') as f:
+        for entry in [plan] + tasks:
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, journal_file)
+
+
+def read_reprocess_journal(journal_file):
+    # returns the plan, the tasks and the ids of the finished tasks
+    plan, tasks, done = None, [], set()
+    with open(journal_file) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be cut off by a crash
+                continue
+            if entry['type'] == 'plan':
+                plan = entry
+            elif entry['type'] == 'task':
+                tasks.append(entry)
+            elif entry['type'] == 'done':
+                done.add(entry['id'])
+    return plan, tasks, done
+
+
+def reprocess_task(task, source_dir, target_dir, resize, copy, extra_formats=None, tier_budgets=None, dryrun=False):
+    source_file = os.path.join(source_dir, task['day'], task['filename'])
+    if not os.path.exists(source_file):
+        # already moved by a run that crashed before it could record it
         return
-    original_filenames_in_destination = set([
-        _extract_original_filename(filename)
-        for filename in destination_filenames
-    ])
-    for counter, filename in enumerate(source_filenames):
-        source_file = os.path.join(day_dir, filename)
-        # FIXME: hardcoded hack because I know the file structure
-        original_filename = _extract_original_filename(filename)
-        if original_filename in original_filenames_in_destination:
-            click.echo(' --> {} exists in destination. skipping.'.format(
-                original_filename
-            ))
-            if bar:
-                bar.update(counter)
-            continue
-        process_image(
-            source_file=source_file,
-            source_filename=original_filename,
-            target_dir=target_dir,
-            copy=copy,
-            resize=resize,
-            dryrun=dryrun,
-        )
-        if bar:
-            bar.update(counter)
+    process_image(
+        source_file=source_file,
+        source_filename=task['source_filename'],
+        target_dir=target_dir,
+        copy=copy,
+        resize=resize,
+        extra_formats=extra_formats,
+        tier_budgets=tier_budgets,
+        dryrun=dryrun,
+        skip_existing=False,
+    )
 
 
-def reprocess_all_images(**kwargs):
-    day_subdirs = [d for d in os.listdir(kwargs['source_dir']) if os.path.isdir(os.path.join(kwargs['source_dir'], d))]
-    for counter, day_subdir in enumerate(day_subdirs):
-        # reprocess_daydir(day_subdir=day_subdir, **kwargs)
-        _reprocess_daydir_with_progress(day_subdir=day_subdir, **kwargs)
+def reprocess_all_images(
+        source_dir,
+        target_dir,
+        resize,
+        copy,
+        extra_formats=None,
+        tier_budgets=None,
+        dryrun=False,
+        jobs=None,
+        journal=None,
+        replan=False
+):
+    source_dir = os.path.abspath(source_dir)
+    target_dir = os.path.abspath(target_dir)
+    journal_file = journal or os.path.join(target_dir, '.reprocess-journal.jsonl')
+    extra_formats = list(extra_formats or [])
+    tier_budgets = dict(tier_budgets or {})
+    plan = dict(
+        type='plan',
+        source_dir=source_dir,
+        target_dir=target_dir,
+        resize=resize,
+        copy=copy,
+        extra_formats=extra_formats,
+        tier_budgets=tier_budgets,
+    )
+    tasks, done = None, set()
+    if not replan and not dryrun and os.path.exists(journal_file):
+        journal_plan, tasks, done = read_reprocess_journal(journal_file)
+        if journal_plan is None or any(journal_plan.get(k) != v for k, v in plan.items()):
+            log('--> {} was planned with other options. planning again.'.format(journal_file))
+            tasks, done = None, set()
+        else:
+            log('--> resuming from {}'.format(journal_file))
+    if tasks is None:
+        log('==> PLANNING reprocess of {} to {}'.format(source_dir, target_dir))
+        with Timer() as t:
+            tasks = plan_reprocess(source_dir, target_dir, resize=resize, extra_formats=extra_formats)
+        plan['total'] = len(tasks)
+        log('--> planned in {:.1f}s'.format(t.elapsed))
+        if not dryrun:
+            write_reprocess_journal(journal_file, plan, tasks)
+    remaining = [task for task in tasks if task['id'] not in done]
+    log('==> REPROCESSING {} images ({} planned, {} already done)'.format(len(remaining), len(tasks), len(done)))
+    failed = 0
+    journal_f = None if dryrun else open(journal_file, 'a')
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            task_kwargs = dict(
+                source_dir=source_dir,
+                target_dir=target_dir,
+                resize=resize,
+                copy=copy,
+                extra_formats=extra_formats,
+                tier_budgets=tier_budgets,
+                dryrun=dryrun,
+            )
+            futures = dict(
+                (executor.submit(reprocess_task, task, **task_kwargs), task)
+                for task in remaining
+            )
+            with click.progressbar(length=len(remaining), label='reprocess') as bar:
+                for future in concurrent.futures.as_completed(futures):
+                    task = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed += 1
+                        log(' [!!!!!] {}/{} failed: {}'.format(task['day'], task['filename'], e))
+                    else:
+                        if journal_f:
+                            journal_f.write(json.dumps({'type': 'done', 'id': task['id']}) + '\n')
+                            journal_f.flush()
+                    bar.update(1)
+    finally:
+        if journal_f:
+            journal_f.close()
+    if failed:
+        log('==> {} images failed. run again to retry them.'.format(failed))
+    elif not dryrun:
+        os.remove(journal_file)
+
+
+# The loops poll for new images right after the camera is expected to have
+# taken the next one. The capture interval is learned from the capture times
+# of the images seen so far (EXIF DateTimeOriginal, or the date prefix of
+# processed filenames) and persisted as json, so it survives --hard-exit
+# restarts. When polls come back empty or fail, the loops back off
+# exponentially, but still poll just after an expected capture. After
+# SCHEDULE_RESET_MISSES misses in a row the clock offset is forgotten and
+# learned again from the next images (e.g. after the camera clock changed).
+# next_poll_at in the schedule file is meant for monitoring.
+SCHEDULE_HISTORY_SIZE = 20
+SCHEDULE_RESET_MISSES = 5
+# misses are counted up to this. the backoff is capped by max_sleep_duration
+# long before that anyway.
+SCHEDULE_MAX_MISSES = 32
+# how far the clock offset moves towards a larger observed offset per poll
+SCHEDULE_OFFSET_DECAY = 0.25
+
+
+def load_schedule(schedule_file):
+    schedule = read_json(schedule_file) if schedule_file else {}
+    schedule.setdefault('captures', [])
+    schedule.setdefault('clock_offset', None)
+    schedule.setdefault('interval', None)
+    schedule.setdefault('misses', 0)
+    schedule.setdefault('next_poll_at', None)
+    return schedule
+
+
+def save_schedule(schedule_file, schedule):
+    if schedule_file:
+        write_json(schedule_file, schedule)
+
+
+def schedule_record_poll(schedule, shot_ats, failed=False, now=None):
+    # shot_ats are the capture times (unix timestamps, camera clock) of the
+    # images that were new in this poll.
+    now = now or time.time()
+    shot_ats = set(shot_ats) - set(schedule['captures'])
+    if failed or not shot_ats:
+        schedule['misses'] = min(schedule['misses'] + 1, SCHEDULE_MAX_MISSES)
+        if schedule['misses'] >= SCHEDULE_RESET_MISSES:
+            schedule['clock_offset'] = None
+        return
+    schedule['misses'] = 0
+    # the camera clock is not in sync with ours, and there is some latency
+    # between capture and the image showing up. the smallest difference seen
+    # is the best estimate for both. a smaller one is taken right away, a
+    # larger one (the camera clock went back) is moved towards gradually.
+    observed = min(now - shot_at for shot_at in shot_ats)
+    if schedule['clock_offset'] is None or observed < schedule['clock_offset']:
+        schedule['clock_offset'] = observed
+    else:
+        schedule['clock_offset'] += (observed - schedule['clock_offset']) * SCHEDULE_OFFSET_DECAY
+    captures = sorted(set(schedule['captures']) | shot_ats)[-SCHEDULE_HISTORY_SIZE:]
+    schedule['captures'] = captures
+    intervals = sorted(b - a for a, b in zip(captures, captures[1:]) if b > a)
+    # the median ignores gaps, e.g. when the camera was off for the night
+    schedule['interval'] = intervals[len(intervals) // 2] if intervals else None
+
+
+def schedule_next_poll_at(schedule, sleep_duration, max_sleep_duration, poll_delay, now=None):
+    now = now or time.time()
+    # after empty or failed polls, wait at least this long
+    # (older schedule files may have more misses than SCHEDULE_MAX_MISSES)
+    misses = min(schedule['misses'], SCHEDULE_MAX_MISSES)
+    backoff = sleep_duration * 2 ** (misses - 1) if misses else 0
+    earliest = now + max(sleep_duration, backoff)
+    if schedule['interval'] and schedule['captures'] and schedule['clock_offset'] is not None:
+        # the first capture after the last one seen whose poll is not
+        # before earliest
+        expected = schedule['captures'][-1] + schedule['clock_offset'] + schedule['interval']
+        if expected + poll_delay < earliest:
+            expected += schedule['interval'] * (int((earliest - expected - poll_delay) // schedule['interval']) + 1)
+        next_poll_at = expected + poll_delay
+    else:
+        next_poll_at = earliest
+    return min(next_poll_at, now + max(max_sleep_duration, sleep_duration))
+
+
+def sleep_until_next_poll(schedule_file, schedule, sleep_duration, max_sleep_duration, poll_delay):
+    now = time.time()
+    schedule['next_poll_at'] = schedule_next_poll_at(
+        schedule,
+        sleep_duration=sleep_duration,
+        max_sleep_duration=max_sleep_duration,
+        poll_delay=poll_delay,
+        now=now,
+    )
+    try:
+        save_schedule(schedule_file, schedule)
+    except Exception as e:
+        # only needed to survive restarts and for monitoring. an unmounted
+        # stick or a full disk must not end the loop.
+        log(e)
+    delay = schedule['next_poll_at'] - now
+    log("--> sleeping for {:.1f}s until {} (interval: {}, misses: {}) <--".format(
+        delay,
+        datetime.datetime.fromtimestamp(schedule['next_poll_at']).strftime('%H:%M:%S'),
+        '{:.0f}s'.format(schedule['interval']) if schedule['interval'] else 'unknown',
+        schedule['misses'],
+    ))
+    time.sleep(delay)
 
 
-def reprocess_all_images_with_progress(**kwargs):
-    day_subdirs = os.listdir(kwargs['source_dir'])
-    with click.progressbar(length=len(day_subdirs), label='total progress') as bar:
-        for counter, day_subdir in enumerate(day_subdirs):
-            # reprocess_daydir(day_subdir=day_subdir, **kwargs)
-            _reprocess_daydir_with_progress(day_subdir=day_subdir, **kwargs)
-            bar.update(counter)
+def download_once(**kwargs):
+    download_all_images(**kwargs)
+    if kwargs['delete_after_download']:
+        drain_deletion_queue(**kwargs)
 
 
 def download_loop(**kwargs):
+    # runs forever for one camera. with several cameras there is one of
+    # these per camera, each in its own thread (see run_camera_workers), so
+    # each camera is paced by its own schedule.
     mount_check_fail_sleep_duration = kwargs['mount_check_fail_sleep_duration']
     check = kwargs['check']
     hard_exit = kwargs['hard_exit']
     image_download_sleep_duration = kwargs['image_download_sleep_duration']
+    camera = kwargs.get('camera', DEFAULT_CAMERA)
+    if kwargs['schedule_file']:
+        schedule_file = kwargs['schedule_file'].format(camera=camera['name'])
+    else:
+        schedule_file = os.path.join(camera_progress_dir(kwargs['progress_dir'], camera), '.schedule.json')
+    schedule = load_schedule(schedule_file)
     while True:
         if not check():
             log(
@@ -515,11 +1508,26 @@ def download_loop(**kwargs):
                 exit(1)
             continue
         try:
-            download_all_images(**kwargs)
+            downloaded = download_all_images(**kwargs)
         except Exception as e:
             log(e)
-        log("--> sleeping for {}s <--".format(image_download_sleep_duration))
-        time.sleep(image_download_sleep_duration)
+            schedule_record_poll(schedule, [], failed=True)
+        else:
+            schedule_record_poll(schedule, [p['shot_at'] for p in downloaded if p.get('shot_at')])
+        if kwargs['delete_after_download']:
+            # the download pass is done, so this is the idle time between
+            # captures.
+            try:
+                drain_deletion_queue(**kwargs)
+            except Exception as e:
+                log(e)
+        sleep_until_next_poll(
+            schedule_file,
+            schedule,
+            sleep_duration=image_download_sleep_duration,
+            max_sleep_duration=kwargs['max_sleep_duration'],
+            poll_delay=kwargs['poll_delay'],
+        )
         if hard_exit:
             exit(1)
 
@@ -558,6 +1566,7 @@ def upload(copy, sync, source_dir, destination, aws_profile, aws_region, dryrun=
             source_dir,
             destination,
             '--include', '"*.JPG"',
+            '--include', '"*.webp"',
             '--exclude', '".*"',
             '--acl', 'public-read',
             '--profile', aws_profile,
@@ -572,6 +1581,7 @@ def upload(copy, sync, source_dir, destination, aws_profile, aws_region, dryrun=
             source_dir,
             destination,
             '--include', '"*.JPG"',
+            '--include', '"*.webp"',
             '--exclude', '".*"',
             '--acl', 'public-read',
             '--cache-control', 'max-age=604800',
@@ -598,6 +1608,8 @@ def build_fake_image_url(key):
 
 
 def report_image_urls(urls, api_url):
+    import requests
+    from furl import furl
     api = furl(api_url)
     token = api.password
     api.password = None
@@ -617,6 +1629,7 @@ def report_image_urls(urls, api_url):
 
 
 def upload_file(s3_transfer, source_path, destination, report_api=None, delete_after_upload=True, dryrun=True, **kwargs):
+    from furl import furl
     url = furl(destination)
     bucket = url.host
     key = str(url.path).lstrip('/')
@@ -630,7 +1643,7 @@ def upload_file(s3_transfer, source_path, destination, report_api=None, delete_a
         extra_args=dict(
             ACL='public-read',
             CacheControl='max-age=604800',
-            ContentType='image/jpeg',
+            ContentType=content_type(source_path),
         )
     )
     if delete_after_upload:
@@ -643,15 +1656,50 @@ def upload_file(s3_transfer, source_path, destination, report_api=None, delete_a
         )
 
 
-def upload2(source_dir, destination, aws_profile, aws_region, limit=None, dryrun=False, **kwargs):
-    session = boto3.Session(
-        profile_name=aws_profile or 'default',
-        region_name=aws_region,
+_s3_transfers = {}
+
+
+def get_s3_transfer(aws_profile, aws_region):
+    # creating the boto3 session and client is slow, so it only happens when
+    # there is something to upload and is then reused by upload_loop.
+    key = (aws_profile or 'default', aws_region)
+    if key not in _s3_transfers:
+        import boto3
+        from boto3.s3.transfer import S3Transfer
+        session = boto3.Session(
+            profile_name=key[0],
+            region_name=aws_region,
+        )
+        _s3_transfers[key] = S3Transfer(session.client('s3'))
+    return _s3_transfers[key]
+
+
+def upload2(
+        source_dir,
+        destination,
+        aws_profile,
+        aws_region,
+        limit=None,
+        include_duplicates=False,
+        dryrun=False,
+        **kwargs
+):
+    # returns the filenames of the uploaded images
+    from furl import furl
+    # originals of near-duplicates are archived with the same layout in
+    # DUPLICATES_DIRNAME (see process --dedup)
+    roots = [source_dir]
+    duplicates_dir = os.path.join(source_dir, DUPLICATES_DIRNAME)
+    if include_duplicates and os.path.isdir(duplicates_dir):
+        roots.append(duplicates_dir)
+    size_dirs = sorted(
+        [(size, os.path.join(root, size)) for root in roots for size in os.listdir(root)],
+        reverse=True,
     )
-    s3_transfer = S3Transfer(session.client('s3'))
+    s3_transfer = None
     upload_count = 0
-    for size in sorted(os.listdir(source_dir), reverse=True):
-        size_dir = os.path.join(source_dir, size)
+    uploaded = []
+    for size, size_dir in size_dirs:
         if size.startswith('.') or not os.path.isdir(size_dir):
             continue
         log(' -> {}'.format(size_dir))
@@ -666,9 +1714,11 @@ def upload2(source_dir, destination, aws_profile, aws_region, limit=None, dryrun
                 if (
                     size.startswith('.') or
                     not os.path.isfile(image_path) or
-                    not image.upper().endswith('.JPG')
+                    os.path.splitext(image)[1].lower() not in CONTENT_TYPES
                 ):
                     continue
+                if s3_transfer is None and not dryrun:
+                    s3_transfer = get_s3_transfer(aws_profile, aws_region)
                 file_destination = furl(destination)
                 file_destination.path.add(size).add(date).add(image)
                 log('     --> upload [{} of {}] {}'.format(
@@ -684,8 +1734,10 @@ def upload2(source_dir, destination, aws_profile, aws_region, limit=None, dryrun
                     **kwargs
                 )
                 upload_count += 1
+                uploaded.append(image)
                 if limit and upload_count >= limit:
-                    return
+                    return uploaded
+    return uploaded
 
 
 def upload_loop(**kwargs):
@@ -693,6 +1745,8 @@ def upload_loop(**kwargs):
     check = kwargs['check']
     hard_exit = kwargs['hard_exit']
     upload_sleep_duration = kwargs['upload_sleep_duration']
+    schedule_file = kwargs['schedule_file'] or os.path.join(kwargs['source_dir'], '.schedule.json')
+    schedule = load_schedule(schedule_file)
     while True:
         if not check():
             log(
@@ -704,11 +1758,20 @@ def upload_loop(**kwargs):
                 exit(1)
             continue
         try:
-            upload2(**kwargs)
+            uploaded = upload2(**kwargs)
         except Exception as e:
             log(e)
-        log("--> sleeping for {}s <--".format(upload_sleep_duration))
-        time.sleep(upload_sleep_duration)
+            schedule_record_poll(schedule, [], failed=True)
+        else:
+            shot_ats = [datetimestr_to_timestamp(image) for image in uploaded]
+            schedule_record_poll(schedule, [shot_at for shot_at in shot_ats if shot_at])
+        sleep_until_next_poll(
+            schedule_file,
+            schedule,
+            sleep_duration=upload_sleep_duration,
+            max_sleep_duration=kwargs['max_sleep_duration'],
+            poll_delay=kwargs['poll_delay'],
+        )
         if hard_exit:
             exit(1)
 
@@ -726,19 +1789,37 @@ def cli():
 @click.option('--mount-check-fail-sleep-duration', default=30, help='in seconds')
 @click.option('--delete-after-download/--no-delete-after-download', default=False, help='delete images from camera after successful download')
 @click.option('--image-download-sleep-duration', default=1, help='in seconds')
+@click.option('--deletion-batch-size', default=10, help='max images to delete from the camera between two download passes')
+@click.option('--deletion-sleep-duration', default=1.0, help='in seconds, between two deletions')
+@click.option('--cameras-config', default=None, help='json file with the cameras to download from. default: a single gopro at 10.5.5.9')
+@click.option('--schedule-file', default=None, help='where the learned capture schedule is kept, {camera} is replaced with the camera name. default: <progress-dir>/[<progress-namespace>/].schedule.json')
+@click.option('--max-sleep-duration', default=600, help='in seconds, upper bound for the sleep between two polls in loop mode')
+@click.option('--poll-delay', default=5, help='in seconds, poll this long after the next image is expected')
 @click.option('--loop/--no-loop', default=False, help='loop forever')
 @click.option('--limit', default=25, help='limit the download to the newest x images. In loop mode, download the x newest images and repeat')
-def cli_download(loop, mount_check_file, **kwargs):
+def cli_download(loop, mount_check_file, cameras_config, **kwargs):
     if mount_check_file is None:
         check = lambda: True
     else:
         check = functools.partial(check_stick_connected, mount_check_file)
     kwargs['check'] = check
+    cameras = load_cameras(cameras_config)
+    if len(cameras) > 1 and kwargs['schedule_file'] and '{camera}' not in kwargs['schedule_file']:
+        raise click.BadParameter('must contain {camera} with several cameras', param_hint='--schedule-file')
     if loop:
-        click.echo('Starting download in loop mode')
-        download_loop(**kwargs)
+        click.echo('Starting download in loop mode for {}'.format(', '.join(c['name'] for c in cameras)))
+        # a camera whose loop died would never be polled again, so exit
+        # non-zero right away and let the supervisor restart everything.
+        failed = run_camera_workers(download_loop, cameras, fail_fast=True, **kwargs)
+        if failed:
+            raise click.ClickException('download failed for {}'.format(', '.join(failed)))
+        # the workers only return on their own with --hard-exit
+        if kwargs['hard_exit']:
+            exit(1)
     else:
-        download_all_images(**kwargs)
+        failed = run_camera_workers(download_once, cameras, **kwargs)
+        if failed:
+            raise click.ClickException('download failed for {}'.format(', '.join(failed)))
 
 
 @cli.command(name='process', help='process downloaded images')
@@ -752,12 +1833,18 @@ def cli_download(loop, mount_check_file, **kwargs):
 @click.option('--image-process-sleep-duration', default=5, help='in seconds')
 @click.option('--loop/--no-loop', default=False, help='loop forever')
 @click.option('--copy/--move', default=False, help='copy or move the file. default: move')
-def cli_process(loop, mount_check_file, **kwargs):
+@click.option('--extra-format', 'extra_formats', multiple=True, callback=parse_extra_formats, help='also write a resized tier as RESOLUTION:FORMAT[:MAX_BYTES], e.g. 640x480:webp:40000. FORMAT is webp or pjpeg (progressive jpeg). can be repeated')
+@click.option('--tier-budget', 'tier_budgets', multiple=True, callback=parse_tier_budgets, help='byte budget for a JPEG tier as RESOLUTION:MAX_BYTES, e.g. 640x480:60000 (jpegoptim --size). can be repeated')
+@click.option('--dedup/--no-dedup', default=False, help='detect near-duplicate frames and skip their --dedup-skip-tier tiers. frames are processed in capture order')
+@click.option('--dedup-threshold', default=4, help='max number of differing bits (of 64) of the perceptual hash for a near-duplicate')
+@click.option('--dedup-skip-tier', 'dedup_skip_tiers', multiple=True, default=['original', '640x480', '320x240'], help='tier (e.g. 640x480, 640x480-webp or original) to skip for near-duplicates. a resolution also skips its extra formats. a skipped original is archived in {} and not uploaded. can be repeated'.format(DUPLICATES_DIRNAME))
+def cli_process(loop, mount_check_file, dedup, dedup_threshold, dedup_skip_tiers, **kwargs):
     if mount_check_file is None:
         check = lambda: True
     else:
         check = functools.partial(check_stick_connected, mount_check_file)
     kwargs['check'] = check
+    kwargs['dedup'] = {'threshold': dedup_threshold, 'skip_tiers': list(dedup_skip_tiers)} if dedup else None
     if kwargs['source_file']:
         # handle
         kwargs.pop('source_dir')
@@ -777,9 +1864,13 @@ def cli_process(loop, mount_check_file, **kwargs):
 @click.option('--resize/--no-resize', default=True, help='resize the images')
 @click.option('--copy/--move', default=False, help='copy or move the file. default: move')
 @click.option('--dryrun/--no-dryrun', default=False, help='do not actually do anything')
+@click.option('--extra-format', 'extra_formats', multiple=True, callback=parse_extra_formats, help='also write a resized tier as RESOLUTION:FORMAT[:MAX_BYTES], e.g. 640x480:webp:40000. FORMAT is webp or pjpeg (progressive jpeg). can be repeated')
+@click.option('--tier-budget', 'tier_budgets', multiple=True, callback=parse_tier_budgets, help='byte budget for a JPEG tier as RESOLUTION:MAX_BYTES, e.g. 640x480:60000 (jpegoptim --size). can be repeated')
+@click.option('--jobs', default=None, type=int, help='number of images to process in parallel. default: number of cpus')
+@click.option('--journal', default=None, help='where the plan and progress are kept. default: <target-dir>/.reprocess-journal.jsonl')
+@click.option('--replan/--no-replan', default=False, help='ignore an existing journal and plan again')
 def cli_reprocess(**kwargs):
     reprocess_all_images(**kwargs)
-    # reprocess_all_images_with_progress(**kwargs)
 
 
 @cli.command(name='upload', help='upload images')
@@ -791,12 +1882,16 @@ def cli_reprocess(**kwargs):
 @click.option('--hard-exit/--no-hard-exit', default=False)
 @click.option('--mount-check-fail-sleep-duration', default=30, help='in seconds')
 @click.option('--upload-sleep-duration', default=10, help='in seconds')
+@click.option('--schedule-file', default=None, help='where the learned capture schedule is kept. default: <source-dir>/.schedule.json')
+@click.option('--max-sleep-duration', default=600, help='in seconds, upper bound for the sleep between two polls in loop mode')
+@click.option('--poll-delay', default=30, help='in seconds, poll this long after the next processed image is expected')
 @click.option('--loop/--no-loop', default=False, help='loop forever')
 @click.option('--copy/--move', default=True, help='copy or move the file. default: copy')
 @click.option('--sync/--no-sync', default=True, help='sync rather than blind copy. does not work with --move. default: --sync')
 @click.option('--dryrun/--no-dryrun', default=False, help='do not actually do anything')
 @click.option('--limit', default=25, help='limit the upload to the newest x images. In loop mode, upload the x newest images and repeat')
 @click.option('--report-api', default='', help='api endpoint to report uploaded files to')
+@click.option('--include-duplicates/--skip-duplicates', default=False, help='also upload the originals of near-duplicate frames archived by process --dedup')
 def cli_upload(loop, mount_check_file, **kwargs):
     if mount_check_file is None:
         check = lambda: True
@@ -810,12 +1905,110 @@ def cli_upload(loop, mount_check_file, **kwargs):
         upload2(**kwargs)
 
 
+def _benchmark_transfer_run(label, source_dir, target_dir, count, size, func):
+    mkdirs(source_dir)
+    mkdirs(target_dir)
+    data = os.urandom(size)
+    filenames = ['G{:07d}.JPG'.format(i) for i in range(count)]
+    for filename in filenames:
+        with open(os.path.join(source_dir, filename), 'wb') as f:
+            f.write(data)
+    methods = collections.Counter()
+    with Timer() as t:
+        for filename in filenames:
+            methods[func(os.path.join(source_dir, filename), os.path.join(target_dir, filename))] += 1
+    click.echo(' {:<22} {:>8.2f}s {:>9.1f} frames/s {:>9.1f} MB/s  {}'.format(
+        label,
+        t.elapsed,
+        count / t.elapsed,
+        count * size / t.elapsed / 1024 / 1024,
+        ', '.join('{} x{}'.format(k, v) for k, v in methods.items()),
+    ))
+    shutil.rmtree(source_dir)
+    shutil.rmtree(target_dir)
+
+
+@cli.command(name='benchmark-transfer', help='benchmark copying and moving frames between two directories')
+@click.option('--source-dir', default=None, help='put this on the same mount as the raw photos. default: the system temp directory')
+@click.option('--target-dir', default=None, help='put this on the same mount as the processed photos. default: the system temp directory')
+@click.option('--count', default=1000, help='number of frames')
+@click.option('--size', default=2 * 1024 * 1024, help='size of each frame in bytes')
+def cli_benchmark_transfer(source_dir, target_dir, count, size):
+    source_dir = source_dir or tempfile.gettempdir()
+    target_dir = target_dir or tempfile.gettempdir()
+    source_dir = os.path.join(source_dir, '.benchmark-transfer-{}'.format(uuid.uuid4()))
+    target_dir = os.path.join(target_dir, '.benchmark-transfer-{}'.format(uuid.uuid4()))
+    click.echo('==> {} frames of {} bytes from {} to {}'.format(count, size, source_dir, target_dir))
+    runs = [
+        ('copy shutil.copy', lambda src, dst: shutil.copy(src, dst) and 'shutil'),
+        ('copy transfer_file', functools.partial(transfer_file, move=False)),
+        ('move shutil.move', lambda src, dst: shutil.move(src, dst) and 'shutil'),
+        ('move transfer_file', functools.partial(transfer_file, move=True)),
+    ]
+    for label, func in runs:
+        _benchmark_transfer_run(label, source_dir, target_dir, count, size, func)
+
+
+# the modules each subcommand imports lazily on its way to doing real work
+# (see the imports inside the functions). used by benchmark-startup.
+SUBCOMMAND_IMPORTS = {
+    'download': ['requests', 'bs4', 'exifread'],
+    'process': ['exifread'],
+    'reprocess': ['exifread'],
+    'upload': ['furl', 'boto3', 'boto3.s3.transfer'],
+}
+
+
+@cli.command(name='benchmark-startup', help='benchmark the startup time of each subcommand')
+@click.option('--repeat', default=10, help='number of runs per subcommand')
+def cli_benchmark_startup(repeat):
+    # measures a fresh interpreter loading this module plus the modules the
+    # subcommand imports on first use, which is what a --hard-exit loop pays
+    # on every iteration before doing any work.
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    runs = [('python -c pass', [sys.executable, '-c', 'pass'])]
+    for name in sorted(SUBCOMMAND_IMPORTS):
+        code = 'import sys; sys.path.insert(0, {!r}); import {}; {}'.format(
+            script_dir,
+            module,
+            '; '.join('import {}'.format(imported) for imported in SUBCOMMAND_IMPORTS[name]),
+        )
+        runs.append((name, [sys.executable, '-c', code]))
+    with open(os.devnull, 'w') as devnull:
+        for label, cmd in runs:
+            timings = []
+            for _ in range(repeat):
+                with Timer() as t:
+                    subprocess.check_call(cmd, stdout=devnull)
+                timings.append(t.elapsed)
+            timings.sort()
+            click.echo(' {:<22} min {:>6.3f}s  median {:>6.3f}s'.format(
+                label,
+                timings[0],
+                timings[len(timings) // 2],
+            ))
+
+
 def disable_stdout_buffering():
+    if hasattr(sys.stdout, 'reconfigure'):
+        # python 3.7+: unbuffered text io is not allowed, but writing
+        # through and flushing on every line has the same effect.
+        sys.stdout.reconfigure(line_buffering=True, write_through=True)
+        return
+    # python 3.0-3.6: no unbuffered text io either, so wrap an unbuffered
+    # binary stream and write through to it.
     # Appending to gc.garbage is a way to stop an object from being
     # destroyed.  If the old sys.stdout is ever collected, it will
     # close() stdout, which is not good.
     gc.garbage.append(sys.stdout)
-    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    sys.stdout = io.TextIOWrapper(
+        open(sys.stdout.fileno(), 'wb', 0),
+        encoding=sys.stdout.encoding,
+        errors=sys.stdout.errors,
+        line_buffering=True,
+        write_through=True,
+    )
 
 
 # Then this will give output in the correct order: